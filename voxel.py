@@ -7,6 +7,109 @@ import sys
 from daxmexplorer.vecmath import normalize
 from daxmexplorer.cxtallite import OrientationMatrix
 
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    # without numba the kernels below are not used, the decorators only
+    # need to keep the module importable
+    _HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+def _as_contiguous(arr):
+    """return arr as a C-contiguous float64 array (None is passed through)"""
+    if arr is None: return None
+    arr = np.asarray(arr, dtype=np.float64)
+    # NOTE: ascontiguousarray would turn a 0-d scalar into a (1,) array
+    return arr if arr.ndim == 0 else np.ascontiguousarray(arr)
+
+
+# NOTE:
+# relative determinant below which a 3x3 normal matrix is treated as
+# singular in the batch calculation
+_SINGULAR_RTOL = 1e-12
+
+
+@njit(cache=True, fastmath=True)
+def _normal_equations_L2(recip_base, plane, scatter_vec):
+    """
+    normal equations A^T F = B^T of the least-squares deformation gradient
+
+    Same math as DAXMvoxel.scatter_vec0(match_measured=True) followed by
+    DAXMvoxel.deformation_gradientL2, written as explicit loops so that
+    numba can compile the whole per-voxel calculation.
+    Only called when numba is available, as plain Python loops it is much
+    slower than the vectorized numpy version.
+    """
+    n = plane.shape[1]
+
+    # strain-free scattering vectors, normalized where the measured
+    # scattering vector is a unit vector
+    q0 = np.empty((3, n))
+    for j in range(n):
+        q0_sq = 0.0
+        q_sq = 0.0
+        for i in range(3):
+            tmp = 0.0
+            for k in range(3):
+                tmp += recip_base[i, k]*plane[k, j]
+            q0[i, j] = tmp
+            q0_sq += tmp*tmp
+            q_sq += scatter_vec[i, j]*scatter_vec[i, j]
+        if abs(np.sqrt(q_sq) - 1.0) <= 1e-4:
+            q0_len = np.sqrt(q0_sq)
+            for i in range(3):
+                q0[i, j] /= q0_len
+
+    # A^T F = B^T with A = q q0^T, B = q0 q0^T
+    At = np.zeros((3, 3))
+    Bt = np.zeros((3, 3))
+    for j in range(n):
+        for a in range(3):
+            for b in range(3):
+                At[a, b] += q0[a, j]*scatter_vec[b, j]
+                Bt[a, b] += q0[a, j]*q0[b, j]
+
+    return At, Bt
+
+
+@njit(cache=True, fastmath=True)
+def _defgrad_L2(recip_base, plane, scatter_vec):
+    """least-squares deformation gradient of a single voxel"""
+    At, Bt = _normal_equations_L2(recip_base, plane, scatter_vec)
+    return np.linalg.solve(At, Bt)
+
+
+@njit(cache=True, parallel=True)
+def _defgrad_L2_batch(recip_base, plane, scatter_vec):
+    """
+    least-squares deformation gradients of a stack of voxels,
+    NaN for voxels whose normal equations are singular
+
+    recip_base:  (n_voxel, 3, 3)
+    plane:       (n_voxel, 3, n_peak)
+    scatter_vec: (n_voxel, 3, n_peak)
+    """
+    n_voxel = recip_base.shape[0]
+    defgrads = np.empty((n_voxel, 3, 3))
+    for v in prange(n_voxel):
+        At, Bt = _normal_equations_L2(recip_base[v], plane[v], scatter_vec[v])
+        # NOTE:
+        # an exception raised inside prange is lost, so singular systems
+        # are detected up front instead of letting solve fail
+        if abs(np.linalg.det(At)) <= _SINGULAR_RTOL*np.max(np.abs(At))**3:
+            defgrads[v] = np.nan
+        else:
+            defgrads[v] = np.linalg.solve(At, Bt)
+    return defgrads
+
+
 class DAXMvoxel(object):
     """
     DAXM voxel stores the crystallograhic information derived from DAXM indexation results.
@@ -51,46 +154,54 @@ class DAXMvoxel(object):
     # ** self <-> self
     R_TSL2TSL = R_APS2APS = R_XHF2XHF = np.eye(3)
     
-    g_to_from = {
-          'APS': {
-                   'APS': R_APS2APS,
-                   'TSL': R_APS2TSL,
-                   'XHF': R_APS2XHF,
-                 },
-          'TSL': {
-                   'APS': R_TSL2APS,
-                   'TSL': R_TSL2TSL,
-                   'XHF': R_TSL2XHF,
-                 },
-          'XHF': {
-                   'APS': R_XHF2APS,
-                   'TSL': R_XHF2TSL,
-                   'XHF': R_XHF2XHF,
-                 },
-    }
+    # NOTE:
+    # rotation matrices stacked as a (target, ref, 3, 3) array so that a
+    # frame conversion needs a single integer-indexed lookup, g_to_from
+    # is the nested-dict view of the same array
+    frame_idx = {'APS': 0, 'TSL': 1, 'XHF': 2}
+    g_stack = np.array([[R_APS2APS, R_APS2TSL, R_APS2XHF],
+                        [R_TSL2APS, R_TSL2TSL, R_TSL2XHF],
+                        [R_XHF2APS, R_XHF2TSL, R_XHF2XHF]])
+    g_to_from = {}
+    for _target, _i in frame_idx.items():
+        g_to_from[_target] = {}
+        for _ref, _j in frame_idx.items():
+            g_to_from[_target][_ref] = g_stack[_i, _j]
+    del _target, _i, _ref, _j
 
     def __init__(self,
                  name=None,
                  ref_frame='APS',
-                 coords=np.zeros(3),
+                 coords=None,
                  pattern_image=None,
                  scatter_vec=None,
                  plane=None,
-                 recip_base=np.eye(3),
-                 peak=np.random.random((2,3)),
+                 recip_base=None,
+                 peak=None,
                  depth=0,
-                 lattice_constant=np.random.random(6),
+                 lattice_constant=None,
                 ):
         self.name = name
         self.ref_frame = ref_frame
-        self.coords = coords
+        # NOTE:
+        # array defaults are created per instance here, default arguments
+        # would be shared by every voxel
+        if coords is None: coords = np.zeros(3)
+        if recip_base is None: recip_base = np.eye(3)
+        if peak is None: peak = np.empty((2, 0))
+        if lattice_constant is None: lattice_constant = np.zeros(6)
+
+        # NOTE:
+        # keep the arrays C-contiguous float64 so that the matrix products
+        # go straight to BLAS without transposed/converted copies
+        self.coords = _as_contiguous(coords)
         self.pattern_image = pattern_image
-        self.scatter_vec = scatter_vec
-        self.plane = plane
-        self.recip_base = recip_base
-        self.peak = peak
+        self.scatter_vec = _as_contiguous(scatter_vec)
+        self.plane = _as_contiguous(plane)
+        self.recip_base = _as_contiguous(recip_base)
+        self.peak = _as_contiguous(peak)
         self.depth = depth
-        self.lattice_constant = lattice_constant
+        self.lattice_constant = _as_contiguous(lattice_constant)
         self.opt_rst = None
         self.strain = None
 
@@ -124,16 +235,15 @@ class DAXMvoxel(object):
         self.name = voxelName
 
         def get_data(h5f, path):
-            tmpdst = h5f[path]
-            datdst = np.zeros(tmpdst.shape)
-            tmpdst.read_direct(datdst)
-            return datdst
+            # single-shot read of the whole (small) dataset
+            return _as_contiguous(h5f[path][()])
 
         with h5py.File(h5file, 'r') as h5f:
             thisvoxel = h5f[voxelName]
 
-            self.pattern_image = thisvoxel.attrs['pattern_image']
-            self.ref_frame     = thisvoxel.attrs['ref_frame']
+            attrs = thisvoxel.attrs
+            self.pattern_image = attrs['pattern_image']
+            self.ref_frame     = attrs['ref_frame']
 
             self.coords                  = get_data(thisvoxel, 'coords')
             self.scatter_vec             = get_data(thisvoxel, 'scatter_vec')
@@ -143,7 +253,7 @@ class DAXMvoxel(object):
             self.depth                   = get_data(thisvoxel, 'depth')
             self.lattice_constant        = get_data(thisvoxel, 'lattice_constant')
 
-            if "{}/{}".format(thisvoxel, 'strain') in h5f.keys():
+            if 'strain' in thisvoxel:
                 self.strain = get_data(thisvoxel, 'strain')
 
     def write(self, h5file=None):
@@ -151,30 +261,48 @@ class DAXMvoxel(object):
         if None in [self.name,h5file] : raise Exception
         
         with h5py.File(h5file, 'a') as h5f:
-            try:
-                del h5f[self.name]
-                voxelStatus = 'updated'
-            except:
-                voxelStatus = 'new'
-
-            h5f.create_dataset("{}/coords".format(self.name), data=self.coords)
-            h5f.create_dataset("{}/scatter_vec".format(self.name), data=self.scatter_vec)
-            h5f.create_dataset("{}/plane".format(self.name), data=self.plane)
-            h5f.create_dataset("{}/recip_base".format(self.name), data=self.recip_base)
-            h5f.create_dataset("{}/peak".format(self.name), data=self.peak)
-            h5f.create_dataset("{}/depth".format(self.name), data=self.depth)
-            h5f.create_dataset("{}/lattice_constant".format(self.name), data=self.lattice_constant)
-
-            if self.strain is not None:
-                h5f.create_dataset("{}/strain".format(self.name), data=self.strain)
-
-            h5f[self.name].attrs['pattern_image'] = self.pattern_image
-            h5f[self.name].attrs['ref_frame']     = self.ref_frame
-            h5f[self.name].attrs['voxelStatus']   = voxelStatus
+            self._write_group(h5f)
+            h5f.flush()
 
+    @classmethod
+    def write_many(cls, voxels, h5file=None):
+        """write a collection of DAXM voxels to a HDF5 archive in one pass"""
+        if h5file is None: raise Exception
+        # NOTE: voxels may be a generator, it is iterated twice below
+        voxels = list(voxels)
+        if any(voxel.name is None for voxel in voxels): raise Exception
 
+        # NOTE: the archive is opened only once for all voxels
+        with h5py.File(h5file, 'a') as h5f:
+            for voxel in voxels:
+                voxel._write_group(h5f)
             h5f.flush()
 
+    def _write_group(self, h5f):
+        """write the DAXM voxel data as a group into an opened HDF5 archive"""
+        try:
+            del h5f[self.name]
+            voxelStatus = 'updated'
+        except:
+            voxelStatus = 'new'
+
+        # NOTE: pin timestamps off for h5py 2.x (already the default in h5py 3)
+        thisvoxel = h5f.require_group(self.name)
+        thisvoxel.create_dataset("coords", data=self.coords, track_times=False)
+        thisvoxel.create_dataset("scatter_vec", data=self.scatter_vec, track_times=False)
+        thisvoxel.create_dataset("plane", data=self.plane, track_times=False)
+        thisvoxel.create_dataset("recip_base", data=self.recip_base, track_times=False)
+        thisvoxel.create_dataset("peak", data=self.peak, track_times=False)
+        thisvoxel.create_dataset("depth", data=self.depth, track_times=False)
+        thisvoxel.create_dataset("lattice_constant", data=self.lattice_constant, track_times=False)
+
+        if self.strain is not None:
+            thisvoxel.create_dataset("strain", data=self.strain, track_times=False)
+
+        thisvoxel.attrs['pattern_image'] = self.pattern_image
+        thisvoxel.attrs['ref_frame']     = self.ref_frame
+        thisvoxel.attrs['voxelStatus']   = voxelStatus
+
     def scatter_vec0(self, match_measured=False):
         """return the strain-free scattering vectors calculated from hkl index"""
         q0 = np.dot(self.recip_base, self.plane)
@@ -186,19 +314,25 @@ class DAXMvoxel(object):
 
     def toFrame(self, target=None):
         """transfer reference frame with given orientation matrix, g"""
-        g_to_from = self.g_to_from
+        frame_idx = self.frame_idx
         if target is None: return
-        if target not in g_to_from: raise Exception
+        if target not in frame_idx: raise Exception
+        # already in the target frame, nothing to rotate
+        if target == self.ref_frame: return
         # NOTE: g matrix represents passive rotation
+        g = self.g_stack[frame_idx[target], frame_idx[self.ref_frame]]
 
-        # convert coordinates
-        self.coords = np.dot(g_to_from[target][self.ref_frame], self.coords)
+        # convert coordinates, scattering vectors and reciprocal base
+        # with a single matrix product, i.e. g (coords, scatter_vec, recip_base)
+        n_vec = self.scatter_vec.shape[1]
+        rotated = np.dot(g, np.column_stack((self.coords,
+                                             self.scatter_vec,
+                                             self.recip_base,
+                                            )))
 
-        # convert scattering vectors
-        self.scatter_vec = np.dot(g_to_from[target][self.ref_frame], self.scatter_vec)
-
-        # convert reciprocal base
-        self.recip_base = np.dot(g_to_from[target][self.ref_frame], self.recip_base)
+        self.coords      = np.ascontiguousarray(rotated[:, 0])
+        self.scatter_vec = np.ascontiguousarray(rotated[:, 1:1+n_vec])
+        self.recip_base  = np.ascontiguousarray(rotated[:, 1+n_vec:])
 
         self.ref_frame = target
 
@@ -209,134 +343,334 @@ class DAXMvoxel(object):
         # ==> F* q0 q0^T = q q0^T
         # ==> F* = (q q0^T)(q0 q0^T)^-1
         #              A       B
+        # Fstar = np.dot(A, np.linalg.pinv(B))
+        # F = F*^(-T) = A^-T B^T
+        # inverting B can be dangerous
+        # ==> solve A^T F = B^T directly instead of forming A^-1
+        if self.scatter_vec.shape != self.plane.shape:
+            raise ValueError("scatter_vec {} and plane {} are not paired, "
+                             "call pair_scattervec_plane first".format(self.scatter_vec.shape,
+                                                                       self.plane.shape))
+
+        if _HAS_NUMBA:
+            return _defgrad_L2(_as_contiguous(self.recip_base),
+                               _as_contiguous(self.plane),
+                               _as_contiguous(self.scatter_vec),
+                              )
+
         q0 = self.scatter_vec0(match_measured=True)
         q = self.scatter_vec
 
         A = np.dot(q, q0.T)
         B = np.dot(q0, q0.T)
-        # Fstar = np.dot(A, np.linalg.pinv(B))
-        # F = F*^(-T) = A^-T B^T
-        # inverting B can be dangerous
-        return np.dot(np.linalg.inv(A).T, B.T)
+        return np.linalg.solve(A.T, B.T)
 
     def deformation_gradient_opt(self, 
                                  eps=1e-1, 
                                  tol=1e-14,
-                                 maxiter=5e6):
-        """extract lattice deformation gardient using nonlinear optimization"""
+                                 maxiter=5e6,
+                                 search_dtype=None):
+        """
+        extract lattice deformation gardient using nonlinear optimization
+
+        search_dtype: optional lower precision (e.g. np.float32) used for a
+                      coarse search before the final float64 refinement
+        """
         # NOTE: a large bound guess is better than a smaller bound
+        import scipy.optimize
 
-        def constraint(constraint_f, e):
-            return len(constraint_f)*e - np.sum(np.abs(constraint_f))
-
-        def objectiveIce(f, vec0, vec):
-            estimate = np.dot(np.eye(3)+f.reshape(3, 3), vec0)
-            return np.sum(1.0 - np.einsum('ij,ij->j',
-                                          vec/np.linalg.norm(vec, axis=0),
-                                          estimate/np.linalg.norm(estimate, axis=0),
-                                         )
-                         )
-        
-        def objective_rmsNorm(f, vec0, vec):
-            # NOTE:
-            # The threshold here cannot be too tight
-            idx_unit_q = np.where(np.absolute(np.linalg.norm(vec,axis=0) - 1.0) < 1e-4)
+        q0_opt = self.scatter_vec0()
+        q_opt  = self.scatter_vec
 
+        # NOTE:
+        # The measured scattering vectors do not change during the
+        # optimization, so their norms, directions and the unit/full
+        # q masks are computed once here and shared by the objectives.
+        # The threshold here cannot be too tight
+        vec_norm = np.linalg.norm(q_opt, axis=0)
+        vec_hat = np.ascontiguousarray(q_opt/vec_norm)
+        idx_unit_q = np.absolute(vec_norm - 1.0) < 1e-4
+        idx_full_q = ~idx_unit_q
+
+        # the normalization here might not be necessary
+        q0_matched = np.copy(q0_opt)
+        q0_matched[:, idx_unit_q] /= np.linalg.norm(q0_matched[:, idx_unit_q], axis=0)
+
+        # NOTE:
+        # all objectives take (f, vec0, vec, vec_norm, vec_hat), the arrays
+        # come through the minimize args so that they can be cast to the
+        # search precision; the boolean q masks stay closures, and not every
+        # objective uses every argument. (I+f) q0_matched has the same
+        # direction as (I+f) q0 and the same length for full q, so the
+        # matched vectors serve all objectives.
+        def estimate_q(f, vec0):
+            # (I+f) q0 as q0 + f q0, np.dot beats a direct dgemm call here
+            return vec0 + np.dot(f.reshape(3,3).astype(vec0.dtype, copy=False), vec0)
+
+        def residual_norm(f, vec0, vec, vec_norm):
             # NOTE:
             # An objective function should remain pure:
             # do not modify input, work with its copy
-            vec0_matched = np.copy(vec0)
-            # the normalization here might not be necessary
-            vec0_matched[:,idx_unit_q] /= np.linalg.norm(vec0_matched[:,idx_unit_q], axis=0)
-
-            estimate = np.dot(np.eye(3)+f.reshape(3,3), vec0_matched)
-            estimate[:,idx_unit_q] /= np.linalg.norm(estimate[:,idx_unit_q], axis=0)
-            return np.sqrt(np.mean(np.square(np.linalg.norm(vec-estimate,axis=0)/np.linalg.norm(vec,axis=0))))
-
-        def objective_smrNorm(f, vec0, vec):
-            # NOTE:
-            # The threshold here cannot be too tight
-            idx_unit_q = np.where(np.absolute(np.linalg.norm(vec,axis=0) - 1.0) < 1e-4)
+            estimate = estimate_q(f, vec0)
+            e_unit = estimate[:,idx_unit_q]
+            est_norm = np.sqrt(np.einsum('ij,ij->j', e_unit, e_unit))
+            estimate[:,idx_unit_q] = e_unit/est_norm
+            return estimate, est_norm, (vec-estimate)/vec_norm
+
+        def objectiveIce(f, vec0, vec, vec_norm, vec_hat):
+            estimate = estimate_q(f, vec0)
+            est_hat = estimate/np.linalg.norm(estimate, axis=0)
+            # sum(1 - cos) over all pairs as one flat dot product
+            return vec_hat.shape[1] - np.vdot(vec_hat.ravel(), est_hat.ravel())
+        
+        def objective_rmsNorm(f, vec0, vec, vec_norm, vec_hat):
+            _, _, residual = residual_norm(f, vec0, vec, vec_norm)
+            return np.sqrt(np.mean(np.einsum('ij,ij->j', residual, residual)))
 
+        def objective_msNorm_grad(f, vec0, vec, vec_norm, vec_hat):
             # NOTE:
-            # An objective function should remain pure:
-            # do not modify input, work with its copy
-            vec0_matched = np.copy(vec0)
-            # the normalization here might not be necessary
-            vec0_matched[:,idx_unit_q] /= np.linalg.norm(vec0_matched[:,idx_unit_q], axis=0)
-
-            estimate = np.dot(np.eye(3)+f.reshape(3,3), vec0_matched)
-            estimate[:,idx_unit_q] /= np.linalg.norm(estimate[:,idx_unit_q], axis=0)
-            return np.square(np.mean(np.sqrt(np.linalg.norm(vec-estimate,axis=0)/np.linalg.norm(vec,axis=0))))
+            # square of objective_rmsNorm, same minimizer but differentiable
+            # at zero residual; returns the value and its analytic gradient
+            # r_j = (q_j - e_j)/|q_j|,  obj = mean(|r_j|^2)
+            # dobj/de_j = -2 r_j/(N |q_j|)
+            # unit q: e_j = E_j/|E_j|  ==>  de_j/dE_j = (I - e_j e_j^T)/|E_j|
+            # E = (I+f) q0  ==>  dobj/df = (dobj/dE) q0^T
+            estimate, est_norm, residual = residual_norm(f, vec0, vec, vec_norm)
+            obj = np.mean(np.einsum('ij,ij->j', residual, residual))
+
+            grad_e = -2.0*residual/(vec_norm*vec.shape[1])
+            e_unit = estimate[:,idx_unit_q]
+            g_unit = grad_e[:,idx_unit_q]
+            grad_e[:,idx_unit_q] = (g_unit - e_unit*np.einsum('ij,ij->j', e_unit, g_unit))/est_norm
+            return obj, np.dot(grad_e, vec0.T).ravel()
+
+        def objective_smrNorm(f, vec0, vec, vec_norm, vec_hat):
+            _, _, residual = residual_norm(f, vec0, vec, vec_norm)
+            return np.square(np.mean(np.sqrt(np.sqrt(np.einsum('ij,ij->j', residual, residual)))))
     
-        def objectiveDante(f, vec0, vec):
-            estimate = np.dot(np.eye(3)+f.reshape(3, 3), vec0)
+        def objectiveDante(f, vec0, vec, vec_norm, vec_hat):
+            estimate = estimate_q(f, vec0)
+            est_norm = np.linalg.norm(estimate, axis=0)
 
             # angular difference
-            angdiff = vec/np.linalg.norm(vec,axis=0) - estimate/np.linalg.norm(estimate,axis=0)
-            angdiff = np.sqrt(np.mean(np.sum(np.square(angdiff), axis=0)))
+            angdiff = vec_hat - estimate/est_norm
+            angdiff = np.sqrt(np.einsum('ij,ij->', angdiff, angdiff)/angdiff.shape[1])
 
             # length difference
-            idx_full_q = np.where(np.absolute(np.linalg.norm(vec,axis=0) - 1) > 1e-10)
-            lendiff = np.linalg.norm(estimate[:, idx_full_q],axis=0) / np.linalg.norm(vec[:, idx_full_q],axis=0)
+            lendiff = est_norm[idx_full_q] / vec_norm[idx_full_q]
             lendiff = np.sqrt(np.mean(np.square(np.log(lendiff))))
 
             return angdiff + lendiff
 
-        import scipy.optimize
-
-        q0_opt = self.scatter_vec0()
-        q_opt  = self.scatter_vec
+        # NOTE:
+        # warm start from the analytic L2 solution, F* = F^-T, which is
+        # already close to the optimum; fall back to f = 0 if the L2
+        # normal equations are singular
+        try:
+            f_L2 = np.linalg.solve(self.deformation_gradientL2().T, np.eye(3)) - np.eye(3)
+            x0 = np.clip(f_L2.ravel(), -eps, eps)
+        except np.linalg.LinAlgError:
+            x0 = np.zeros(3*3)
+        opt_args = (q0_matched, q_opt, vec_norm, vec_hat)
+
+        # NOTE:
+        # optional coarse search in lower precision, its result is only
+        # used as the starting point of the float64 refinement below
+        if search_dtype is not None and np.dtype(search_dtype) != np.float64:
+            coarse_rst = scipy.optimize.minimize(objective_msNorm_grad,
+                                                 x0 = x0,
+                                                 args = tuple(np.asarray(a, dtype=search_dtype) for a in opt_args),
+                                                 jac = True,
+                                                 method = 'L-BFGS-B',
+                                                 tol = max(tol, np.finfo(search_dtype).eps),
+                                                 bounds = [(-eps, eps)]*(3*3),
+                                                 options={'maxiter':int(maxiter),
+                                                         },
+                                                )
+            x0 = coarse_rst.x
 
-        self.opt_rst = scipy.optimize.minimize(objective_rmsNorm,
-                                               x0 = np.zeros(3*3),
-                                               args = (q0_opt,q_opt),
+        self.opt_rst = scipy.optimize.minimize(objective_msNorm_grad,
+                                               x0 = x0,
+                                               args = opt_args,
+                                               jac = True,
                                         #   method = 'Nelder-mead',  # demo error ~ 1e-14
                                         #   method = 'BFGS',         # demo error ~ 1e-8 
-                                               method = 'COBYLA',       # demo error ~ 1e-14
+                                        #   method = 'COBYLA',       # demo error ~ 1e-14
+                                               method = 'L-BFGS-B',
                                                tol = tol,
-                                               constraints = {'type':'ineq',
-                                                              'fun': lambda x: constraint(x,eps),
-                                                             },
+                                               bounds = [(-eps, eps)]*(3*3),
+                                               # ftol acts on the squared objective
                                                options={'maxiter':int(maxiter),
+                                                        'ftol':tol*tol,
                                                        },
                                                 )
+        # report the rms value, i.e. objective_rmsNorm at the solution
+        self.opt_rst.fun = np.sqrt(self.opt_rst.fun)
         # print(self.opt_rst)
         fstar = np.eye(3) + self.opt_rst.x.reshape(3,3)
-        return np.transpose(np.linalg.inv(fstar))
+        # F = F*^(-T), solved directly as F*^T F = I
+        return np.linalg.solve(fstar.T, np.eye(3))
 
     def pair_scattervec_plane(self):
         """pair the recorded scattering vectors and the indexation results"""
-        old_scatter_vec = np.array(self.scatter_vec)
+        import scipy.optimize
+
+        # every indexed plane needs its own measured scattering vector
+        if self.plane.shape[1] > self.scatter_vec.shape[1]:
+            raise ValueError("{} indexed planes cannot be paired with {} scattering vectors".format(
+                             self.plane.shape[1], self.scatter_vec.shape[1]))
+
+        # normalize each scatter vector (column stacked)
+        qs = np.ascontiguousarray(normalize(self.scatter_vec, axis=0))
+        q0 = np.ascontiguousarray(normalize(np.dot(self.recip_base, self.plane), axis=0))
 
-        if self.peak.shape[0] < old_scatter_vec.shape[0]:
-            old_peaks = np.zeros((2, self.scatter_vec.shape[1]))
+        # cosine similarity between every (q0, qs) pair in one gemm,
+        # pair q0 and qs with the smallest total angular difference
+        # NOTE:
+        # solving it as an assignment problem ensures that each measured
+        # scattering vector is paired with at most one plane
+        _, idx = scipy.optimize.linear_sum_assignment(-np.dot(q0.T, qs))
+
+        # update scatter vectors
+        # NOTE: fancy indexing already returns new arrays, no need to copy
+        # NOTE: peaks parsed without peaksXY are a (2,) placeholder
+        if self.peak.ndim != 2 or self.peak.shape[1] < self.scatter_vec.shape[1]:
+            self.peak = np.zeros((2, idx.shape[0]))
         else:
-            old_peaks = np.array(self.peak)
+            self.peak = np.ascontiguousarray(self.peak[:, idx])
+        self.scatter_vec = np.ascontiguousarray(self.scatter_vec[:, idx])
 
-        new_scatter_vec = np.zeros(self.plane.shape)
-        new_peak = np.zeros((2, self.plane.shape[1]))
+        return None
 
-        qs = normalize(old_scatter_vec, axis=0)   # normalize each scatter vector (column stacked)
-        q0 = normalize(np.dot(self.recip_base, self.plane), axis=0)
 
-        for i in range(self.plane.shape[1]):
-            angular_diff = np.absolute(1.0 - np.dot(q0[:, i].T, qs))
-            # pair q0 and qs with the smallest angular difference
-            idx = np.argmin(angular_diff)
-            new_scatter_vec[:, i] = old_scatter_vec[:, idx]
-            new_peak[:, i] = old_peaks[:, idx]
+class DAXMvoxelArray(object):
+    """
+    Collection of DAXM voxels stored as stacked arrays (structure of arrays),
+    so that the strain quantification of all voxels can be done in one go.
+    All voxels must have the same number of indexed peaks.
 
-            # remove the paired entry
-            qs = np.delete(qs, idx, axis=1)
-            old_scatter_vec = np.delete(old_scatter_vec, idx, axis=1)
-            old_peaks = np.delete(old_peaks, idx, axis=1)
+    @para:
+    name:             list of voxel IDs
+    ref_frame:        list of reference frames
+    coords:           voxel positions                     (n_voxel, 3)
+    pattern_image:    list of associated image names
+    scatter_vec:      measured scattering vectors         (n_voxel, 3, n_peak)
+    plane:            Miller index of indexed planes      (n_voxel, 3, n_peak)
+    recip_base:       reciprocal bases                    (n_voxel, 3, 3)
+    peak:             diffraction peak coordinates on CCD (n_voxel, 2, n_peak)
+    depth:            wire positions                      (n_voxel,)
+    lattice_constant: lattice constants                   (n_voxel, 6)
 
-        # update scatter vectors
-        self.scatter_vec = new_scatter_vec
-        self.peak = new_peak
+    NOTE:
+    strain and opt_rst are not stacked, from_voxels/to_voxels drop them
 
-        return None
+    """
+
+    def __init__(self,
+                 name,
+                 ref_frame,
+                 coords,
+                 pattern_image,
+                 scatter_vec,
+                 plane,
+                 recip_base,
+                 peak,
+                 depth,
+                 lattice_constant,
+                ):
+        self.name = list(name)
+        self.ref_frame = list(ref_frame)
+        self.coords = _as_contiguous(coords)
+        self.pattern_image = list(pattern_image)
+        self.scatter_vec = _as_contiguous(scatter_vec)
+        self.plane = _as_contiguous(plane)
+        self.recip_base = _as_contiguous(recip_base)
+        self.peak = _as_contiguous(peak)
+        self.depth = _as_contiguous(depth)
+        self.lattice_constant = _as_contiguous(lattice_constant)
+
+    def __len__(self):
+        return len(self.name)
+
+    def __repr__(self):
+        return '\n'.join([
+          'voxels: {}'.format(len(self)),
+          'peaks per voxel: {}'.format(self.scatter_vec.shape[2]),
+        ])
+
+    @classmethod
+    def from_voxels(cls, voxels):
+        """stack a list of DAXMvoxel into a DAXMvoxelArray"""
+        voxels = list(voxels)
+        if len(voxels) == 0:
+            raise ValueError("cannot build a DAXMvoxelArray from an empty voxel list")
+
+        return cls(name=[voxel.name for voxel in voxels],
+                   ref_frame=[voxel.ref_frame for voxel in voxels],
+                   coords=np.stack([voxel.coords for voxel in voxels]),
+                   pattern_image=[voxel.pattern_image for voxel in voxels],
+                   scatter_vec=np.stack([voxel.scatter_vec for voxel in voxels]),
+                   plane=np.stack([voxel.plane for voxel in voxels]),
+                   recip_base=np.stack([voxel.recip_base for voxel in voxels]),
+                   peak=np.stack([voxel.peak for voxel in voxels]),
+                   depth=np.array([voxel.depth for voxel in voxels]),
+                   lattice_constant=np.stack([voxel.lattice_constant for voxel in voxels]),
+                  )
+
+    def to_voxels(self):
+        """split the DAXMvoxelArray back into a list of DAXMvoxel"""
+        # NOTE:
+        # copy the slices, otherwise every voxel would hold views into
+        # the stacked arrays and share their buffers
+        return [DAXMvoxel(name=self.name[i],
+                          ref_frame=self.ref_frame[i],
+                          coords=np.copy(self.coords[i]),
+                          pattern_image=self.pattern_image[i],
+                          scatter_vec=np.copy(self.scatter_vec[i]),
+                          plane=np.copy(self.plane[i]),
+                          recip_base=np.copy(self.recip_base[i]),
+                          peak=np.copy(self.peak[i]),
+                          depth=self.depth[i],
+                          lattice_constant=np.copy(self.lattice_constant[i]),
+                         )
+                for i in range(len(self))]
+
+    def scatter_vec0(self, match_measured=False):
+        """return the strain-free scattering vectors of all voxels"""
+        q0 = np.matmul(self.recip_base, self.plane)
+        if match_measured:
+            idx_unit_q = np.absolute(np.linalg.norm(self.scatter_vec, axis=1) - 1) <= 1e-4
+            q0 = np.where(idx_unit_q[:, np.newaxis, :],
+                          q0/np.linalg.norm(q0, axis=1, keepdims=True),
+                          q0,
+                         )
+
+        return q0
+
+    def deformation_gradientL2(self):
+        """extract lattice deformation gradients of all voxels using least-squares regression"""
+        # same as DAXMvoxel.deformation_gradientL2, with the normal
+        # equations of all voxels assembled and solved as one batch
+        # F = A^-T B^T with A = q q0^T, B = q0 q0^T
+        if self.scatter_vec.shape != self.plane.shape:
+            raise ValueError("scatter_vec {} and plane {} are not paired, "
+                             "pair each DAXMvoxel before from_voxels".format(self.scatter_vec.shape,
+                                                                              self.plane.shape))
+
+        if _HAS_NUMBA:
+            return _defgrad_L2_batch(self.recip_base, self.plane, self.scatter_vec)
+
+        q0 = self.scatter_vec0(match_measured=True)
+        q = self.scatter_vec
+
+        At = np.einsum('vij,vkj->vki', q, q0, optimize=True)
+        Bt = np.einsum('vij,vkj->vki', q0, q0, optimize=True)
+
+        # same singularity test as _defgrad_L2_batch, NaN for singular voxels
+        singular = np.absolute(np.linalg.det(At)) <= _SINGULAR_RTOL*np.max(np.absolute(At), axis=(1, 2))**3
+        defgrads = np.full(At.shape, np.nan)
+        defgrads[~singular] = np.linalg.solve(At[~singular], Bt[~singular])
+        return defgrads
 
 
 if __name__ == "__main__":
@@ -412,6 +746,41 @@ if __name__ == "__main__":
     print("\t-->with error:{}".format(np.linalg.norm(deviator(test_f) - deviator(test_f_opt))))
     print("="*20 + "\n")
 
+    # ----- batch (DAXMvoxelArray) demo ----- #
+    # stack voxels with different strains, quantify them in one go and
+    # compare with the per-voxel results
+    test_voxels = []
+    for i in range(10):
+        tmp_f = np.eye(3) + test_eps*(np.ones(9)-2.*np.random.random(9)).reshape(3,3)
+        tmp_vec = np.dot(np.transpose(np.linalg.inv(tmp_f)), test_vec0)
+        tmp_vec[:, n:] /= np.linalg.norm(tmp_vec[:, n:], axis=0)
+        test_voxels.append(DAXMvoxel(name='voxel_{}'.format(i),
+                                     scatter_vec=tmp_vec,
+                                     plane=test_plane,
+                                     recip_base=test_recip_base,
+                                     peak=np.random.random((2, N)),
+                                    ))
+
+    daxmVoxels = DAXMvoxelArray.from_voxels(test_voxels)
+    print("stacked voxels\n", daxmVoxels)
+    test_fs_batch = daxmVoxels.deformation_gradientL2()
+    test_fs_single = np.array([voxel.deformation_gradientL2() for voxel in test_voxels])
+    print("\t-->batch vs per-voxel L2 error:{}".format(np.max(np.absolute(test_fs_batch - test_fs_single))))
+
+    # a voxel whose indexed planes are all parallel cannot be solved,
+    # the batch calculation returns NaN for it and keeps the others
+    daxmVoxels.plane[0] = np.outer([1, 1, 0], np.arange(1, N+1))
+    test_fs_batch = daxmVoxels.deformation_gradientL2()
+    print("\t-->singular voxel gives NaN:{}".format(np.all(np.isnan(test_fs_batch[0]))))
+    print("\t-->other voxels error:{}".format(np.max(np.absolute(test_fs_batch[1:] - test_fs_single[1:]))))
+
+    back_voxels = daxmVoxels.to_voxels()
+    print("\t-->round trip error:{}".format(max(np.max(np.absolute(a.scatter_vec - b.scatter_vec))
+                                                 for a, b in zip(back_voxels, test_voxels))))
+    print("\t-->shares buffer with stack:{}".format(np.shares_memory(back_voxels[0].scatter_vec,
+                                                                       daxmVoxels.scatter_vec)))
+    print("="*20 + "\n")
+
     # ----- HDF5 support demo ----- #
     # write and read data to HDF5 archive
     daxmVoxel.write(h5file='dummy_data.h5')